@@ -3,14 +3,143 @@
 VisualEditor (ve) - 基于Textual 7.3.0的文本编辑器
 """
 
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+import stat
 import sys
 from pathlib import Path
 from textual import on
 from textual.app import App, ComposeResult
+from textual.timer import Timer
 from textual.widgets import (
     Header, Footer, TextArea, Input
 )
-import asyncio
+
+# fdatasync 不刷新 mtime 等元数据，比 fsync 便宜；不支持的平台退回 fsync
+datasync = getattr(os, "fdatasync", os.fsync)
+# Windows 下 os.open 默认是文本模式，写入时会把 \n 改成 \r\n
+O_BINARY = getattr(os, "O_BINARY", 0)
+COMMAND_PATTERN = re.compile(r"(\S+)\s*(.*)")
+
+
+def content_hash(data: bytes) -> bytes:
+    """内容摘要，用于判断缓冲区是否与磁盘上的版本一致"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def document_fingerprint(document) -> tuple[int, int]:
+    """行数与字符总数，任何插入或删除都会改变它，且无需拼出整个文本"""
+    return document.line_count, sum(map(len, document.lines))
+
+
+def read_text_file(path: Path) -> str:
+    """按文件大小预分配缓冲区，用 readinto 无缓冲读入后一次解码"""
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            n = f.readinto(view[offset:])
+            if not n:
+                break
+            offset += n
+        view.release()
+        del buf[offset:]
+        # 读取期间文件变大，或 /proc 等报告大小为 0 的文件，把剩余部分也读进来
+        rest = f.readall()
+    if rest:
+        buf += rest
+    return buf.decode("utf-8")
+
+
+def open_temp_file(path: Path) -> tuple[int, Path]:
+    """在目标文件旁新建一个不与已有文件重名的临时文件，返回其 fd 和路径"""
+    while True:
+        tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+        try:
+            fd = os.open(
+                tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY, 0o666
+            )
+        except FileExistsError:
+            continue
+        return fd, tmp_path
+
+
+def write_fd(fd: int, data: bytes, sync: bool = False) -> None:
+    """直接用 os.write 写入已编码的内容并关闭 fd，绕过 Python 的缓冲层
+
+    sync 为 True 时在关闭前用同一个文件描述符刷盘，无需再次打开文件。
+    """
+    data = memoryview(data)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        if sync:
+            datasync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_dir(path: Path) -> None:
+    """刷新目录项，让之前的 os.replace 落盘；Windows 无法打开目录，跳过"""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_file(path: Path) -> None:
+    """把已保存但未刷盘的文件刷到磁盘，用于退出时本次无需写入的情况"""
+    # Windows 只能对可写句柄刷盘；POSIX 只读打开即可，只读文件也能同步
+    fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    try:
+        datasync(fd)
+    finally:
+        os.close(fd)
+    sync_dir(path.parent)
+
+
+def save_bytes_file(
+    path: Path, data: bytes, ensured_dirs: set[Path], sync: bool = False
+) -> None:
+    """先写临时文件再原子替换目标文件，供工作线程调用
+
+    已确认存在的父目录记录在 ensured_dirs 中，之后保存不再重复 mkdir。
+    由于是替换而非原地写入，目标文件的硬链接会被断开（其他链接仍指向旧内容），
+    属主也会变为当前用户。
+    """
+    parent = path.parent
+    if parent not in ensured_dirs:
+        parent.mkdir(parents=True, exist_ok=True)
+        ensured_dirs.add(parent)
+
+    try:
+        fd, tmp_path = open_temp_file(path)
+    except FileNotFoundError:
+        # 目录在确认之后被删除，重新创建后再试一次
+        ensured_dirs.discard(parent)
+        parent.mkdir(parents=True, exist_ok=True)
+        ensured_dirs.add(parent)
+        fd, tmp_path = open_temp_file(path)
+    try:
+        write_fd(fd, data, sync)
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(path.stat().st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if sync:
+        sync_dir(parent)
 
 
 class VisualEditor(App):
@@ -40,8 +169,13 @@ class VisualEditor(App):
         super().__init__(*args, **kwargs)
         self.current_file: Path | None = None
         self.is_modified = False
-        self.original_content = ""
-        self.check_modified_task = None
+        self.original_hash = content_hash(b"")
+        self.original_fingerprint = (1, 0)
+        self._modified_timer: Timer | None = None
+        self._title_timer: Timer | None = None
+        self.ensured_dirs: set[Path] = set()
+        self.encoded_text: bytes | None = None
+        self._loading = False
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -53,150 +187,222 @@ class VisualEditor(App):
         )
         yield Footer()
 
-    def on_mount(self) -> None:
+    async def on_mount(self) -> None:
         self.editor = self.query_one("#editor", TextArea)
         self.command_input = self.query_one("#command-input", Input)
-        self.original_content = self.editor.text
 
         if self.current_file:
-            self.load_or_create_file(self.current_file)
+            await self.load_or_create_file(self.current_file)
 
         self.update_title()
-        self.check_modified_task = asyncio.create_task(self.check_content_modified())
 
-    async def check_content_modified(self):
-        """定期检查内容是否被修改"""
-        try:
-            while True:
-                await asyncio.sleep(0.5)
-                current_content = self.editor.text
-                if current_content != self.original_content:
-                    if not self.is_modified:
-                        self.is_modified = True
-                        self.update_title()
-                else:
-                    if self.is_modified:
-                        self.is_modified = False
-                        self.update_title()
-        except asyncio.CancelledError:
-            pass
+    @on(TextArea.Changed, "#editor")
+    def on_editor_changed(self) -> None:
+        """内容变化时重置防抖定时器，停止输入后再检查是否被修改"""
+        # 载入文件时 load_text 也会发出 Changed，内容与刚记录的原始内容一致，无需重新检查
+        loading, self._loading = self._loading, False
+        if loading and (
+            document_fingerprint(self.editor.document) == self.original_fingerprint
+        ):
+            return
+        self.encoded_text = None
+        self.stop_modified_timer()
+        self._modified_timer = self.set_timer(0.3, self.recheck_modified)
+
+    def stop_modified_timer(self) -> None:
+        """停止并释放防抖定时器，重复调用无副作用"""
+        if self._modified_timer is not None:
+            self._modified_timer.stop()
+            self._modified_timer = None
+
+    def stop_timers(self) -> None:
+        """退出前停止并释放所有定时器"""
+        self.stop_modified_timer()
+        if self._title_timer is not None:
+            self._title_timer.stop()
+            self._title_timer = None
+
+    def recheck_modified(self) -> None:
+        """比较当前内容与原始内容，更新修改状态"""
+        self._modified_timer = None
+        # 指纹不同必然已修改，只有指纹相同时才需要计算摘要
+        is_modified = (
+            document_fingerprint(self.editor.document) != self.original_fingerprint
+            or content_hash(self.encode_text()) != self.original_hash
+        )
+        if is_modified != self.is_modified:
+            self.is_modified = is_modified
+            self.update_title()
+
+    def encode_text(self) -> bytes:
+        """返回缓冲区的 UTF-8 编码，内容未变化时直接复用，不再拼出整个文本"""
+        if self.encoded_text is None:
+            self.encoded_text = self.editor.text.encode("utf-8")
+        return self.encoded_text
 
     def update_title(self):
+        """合并短时间内的多次标题更新，只在最后一次后刷新"""
+        if self._title_timer is not None:
+            self._title_timer.stop()
+        self._title_timer = self.set_timer(0.05, self.apply_title)
+
+    def apply_title(self):
         """只显示文件名，不显示路径"""
-        if self.current_file:
-            filename = self.current_file.name
-            self.title = f"{filename}{'*' if self.is_modified else ''}"
-        else:
-            self.title = f"未命名{'*' if self.is_modified else ''}"
-        self.sub_title = "编辑器"
+        self._title_timer = None
+        filename = self.current_file.name if self.current_file else "未命名"
+        title = f"{filename}{'*' if self.is_modified else ''}"
+        if title == self.title:
+            return
+        self.title = title
         self.refresh()
 
-    def load_or_create_file(self, file_path: Path) -> None:
+    async def load_or_create_file(self, file_path: Path) -> None:
         """加载已有文件或创建新文件"""
+        editor = self.editor
         try:
-            abs_path = file_path.expanduser().resolve()
+            abs_path = Path(os.path.realpath(os.path.expanduser(file_path)))
 
             if abs_path.exists() and abs_path.is_file():
-                with open(abs_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                self.editor.text = content
+                content = await asyncio.to_thread(read_text_file, abs_path)
+                self._loading = True
+                editor.text = content
                 self.notify(f"已打开文件: {abs_path}", severity="success")
             else:
-                self.editor.text = ""
+                self._loading = True
+                editor.text = ""
                 self.notify(f"已创建新文件: {abs_path}", severity="success")
 
             self.current_file = abs_path
-            self.original_content = self.editor.text
+            self.encoded_text = None
+            self.original_hash = content_hash(self.encode_text())
+            self.original_fingerprint = document_fingerprint(editor.document)
             self.is_modified = False
             self.update_title()
 
         except Exception as e:
             self.notify(f"操作文件失败: {e}", severity="error")
 
-    async def action_save_file(self) -> None:
-        """保存当前文件"""
+    async def action_save_file(self, sync: bool = False) -> None:
+        """保存当前文件，sync 为 True 时同时刷到磁盘"""
         if self.current_file is None:
             self.notify("请先通过 open 命令打开/创建文件或使用 save <path> 另存为", severity="warning")
             return
 
+        # 防抖检查尚未执行时先立即检查，避免刚输入的内容被当作未修改
+        if self._modified_timer is not None:
+            self.stop_modified_timer()
+            self.recheck_modified()
+        if not self.is_modified and self.current_file.exists():
+            if sync:
+                try:
+                    await asyncio.to_thread(sync_file, self.current_file)
+                except Exception as e:
+                    self.notify(f"同步到磁盘失败: {e}", severity="error")
+            self.notify("无修改，无需保存", severity="information")
+            return
+
         try:
-            self.current_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.current_file, "w", encoding="utf-8") as f:
-                f.write(self.editor.text)
-            self.is_modified = False
-            self.original_content = self.editor.text
-            self.update_title()
+            data = self.encode_text()
+            fingerprint = document_fingerprint(self.editor.document)
+            await asyncio.to_thread(
+                save_bytes_file, self.current_file, data, self.ensured_dirs, sync
+            )
+            self.mark_saved(data, fingerprint)
             self.notify(f"已保存文件: {self.current_file}", severity="success")
         except Exception as e:
             self.notify(f"保存失败: {e}", severity="error")
 
+    def mark_saved(self, data: bytes, fingerprint: tuple[int, int]) -> None:
+        """把写入磁盘的快照记为原始内容；保存期间又有编辑时仍算作已修改"""
+        self.original_hash = content_hash(data)
+        self.original_fingerprint = fingerprint
+        if self.encoded_text is data:
+            # 缓存未被清空，说明保存期间没有编辑
+            self.is_modified = False
+        else:
+            self.stop_modified_timer()
+            self.recheck_modified()
+        self.update_title()
+
     async def save_as_file(self, file_path: Path) -> None:
         """另存为（直接覆盖）"""
         try:
-            save_path = file_path.expanduser().resolve()
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(save_path, "w", encoding="utf-8") as f:
-                f.write(self.editor.text)
+            save_path = Path(os.path.realpath(os.path.expanduser(file_path)))
+            data = self.encode_text()
+            fingerprint = document_fingerprint(self.editor.document)
+            await asyncio.to_thread(
+                save_bytes_file, save_path, data, self.ensured_dirs
+            )
 
             self.current_file = save_path
-            self.is_modified = False
-            self.original_content = self.editor.text
-            self.update_title()
+            self.mark_saved(data, fingerprint)
             self.notify(f"已另存为: {save_path}", severity="success")
         except Exception as e:
             self.notify(f"另存为失败: {e}", severity="error")
 
     async def action_quit_app(self) -> None:
         """直接退出，不保存"""
-        if self.check_modified_task:
-            self.check_modified_task.cancel()
+        self.stop_timers()
         self.exit()
 
     async def action_save_and_quit(self) -> None:
         """保存并退出"""
         if self.current_file is not None:
-            await self.action_save_file()
-        if self.check_modified_task:
-            self.check_modified_task.cancel()
+            await self.action_save_file(sync=True)
+        self.stop_timers()
         self.exit()
 
     async def action_command_input(self) -> None:
         """显示/隐藏命令输入框"""
-        if self.command_input.display:
-            self.command_input.display = False
+        command_input = self.command_input
+        if command_input.display:
+            command_input.display = False
         else:
-            self.command_input.display = True
-            self.command_input.focus()
+            command_input.display = True
+            command_input.focus()
 
     @on(Input.Submitted, "#command-input")
     async def handle_command(self) -> None:
         """处理命令输入"""
-        command_text = self.command_input.value.strip()
-        self.command_input.value = ""
+        command_input = self.command_input
+        command_text = command_input.value.strip()
+        command_input.value = ""
         if not command_text:
             return
 
-        parts = command_text.split(maxsplit=1)
-        command = parts[0].lower()
-
-        if command == "open":
-            if len(parts) < 2:
-                self.notify("用法: open <path>", severity="warning")
-                return
-            file_path = Path(parts[1])
-            self.load_or_create_file(file_path)
+        command, arg = COMMAND_PATTERN.fullmatch(command_text).groups()
+        if not command.islower():
+            command = command.lower()
 
-        elif command == "save":
-            if len(parts) < 2:
-                await self.action_save_file()
-            else:
-                await self.save_as_file(Path(parts[1]))
+        handler = self.COMMANDS.get(command)
+        if handler is None:
+            self.notify(f"未知命令: {command}", severity="error")
+            return
+        await handler(self, arg)
 
-        elif command == "quit":
-            await self.action_quit_app()
+    async def command_open(self, arg: str) -> None:
+        """open <path>: 打开或创建文件"""
+        if not arg:
+            self.notify("用法: open <path>", severity="warning")
+            return
+        await self.load_or_create_file(Path(arg))
 
+    async def command_save(self, arg: str) -> None:
+        """save [path]: 保存，或另存为到指定路径"""
+        if not arg:
+            await self.action_save_file()
         else:
-            self.notify(f"未知命令: {command}", severity="error")
+            await self.save_as_file(Path(arg))
+
+    async def command_quit(self, arg: str) -> None:
+        """quit: 直接退出"""
+        await self.action_quit_app()
+
+    COMMANDS = {
+        "open": command_open,
+        "save": command_save,
+        "quit": command_quit,
+    }
 
 def main():
     """主函数"""